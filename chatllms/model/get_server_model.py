@@ -5,6 +5,7 @@ import torch
 from peft import PeftModel
 from peft.tuners.lora import LoraLayer
 from transformers import AutoModelForCausalLM, BitsAndBytesConfig
+from transformers.utils import is_flash_attn_2_available
 
 
 def get_server_model(args: Dict) -> torch.nn.Module:
@@ -32,6 +33,14 @@ def get_server_model(args: Dict) -> torch.nn.Module:
                      (torch.bfloat16 if args.bf16 else torch.float32))
     torch_dtype = (torch.float32 if args.fp16 else
                    (torch.bfloat16 if args.bf16 else torch.float32))
+
+    # Use a fused attention kernel, models loaded with remote code use their own attention implementation.
+    # FlashAttention-2 only supports half precision weights, fall back to SDPA otherwise.
+    attn_implementation = args.attn_implementation
+    if attn_implementation is None and not args.trust_remote_code:
+        attn_implementation = ('flash_attention_2'
+                               if is_flash_attn_2_available() and torch_dtype
+                               in (torch.float16, torch.bfloat16) else 'sdpa')
     # Load the model.
     model = AutoModelForCausalLM.from_pretrained(
         args.model_name_or_path,
@@ -50,9 +59,11 @@ def get_server_model(args: Dict) -> torch.nn.Module:
             bnb_4bit_quant_type=args.quant_type  # {'fp4', 'nf4'}
         ),
         torch_dtype=torch_dtype,
+        attn_implementation=attn_implementation,
         use_auth_token=args.use_auth_token,
         trust_remote_code=args.trust_remote_code,
     )
+    model.generation_config.use_cache = True
 
     # Print a message if the GPU supports bfloat16.
     if compute_dtype == torch.float16 and args.bits == 4:
@@ -3,13 +3,13 @@ import os
 from dataclasses import dataclass
 from typing import Any, Dict, List, Tuple, Union
 
-import evaluate
 import jieba
 import numpy as np
 import torch
 from datasets import load_dataset
 from nltk.translate.bleu_score import SmoothingFunction, sentence_bleu
 from rouge_chinese import Rouge
+from torch.utils.data import DataLoader
 from tqdm.auto import tqdm
 from transformers import (PreTrainedModel, PreTrainedTokenizer, Trainer,
                           TrainerCallback)
@@ -215,35 +215,34 @@ class MMLUEvalCallback(TrainerCallback):
         self.trainer = trainer
         self.tokenizer = tokenizer
 
-        # Load the appropriate MMLU dataset based on the value of 'mmlu_dataset'.
+        # Get the appropriate MMLU data files based on the value of 'mmlu_dataset'.
         if args.mmlu_dataset == 'mmlu-zs':
-            mmlu_dataset = load_dataset(
-                'json',
-                data_files={
-                    'eval':
-                    os.path.join(data_dir, 'mmlu/zero_shot_mmlu_val.json'),
-                    'test':
-                    os.path.join(data_dir, 'mmlu/zero_shot_mmlu_test.json'),
-                },
-            )
-            mmlu_dataset = mmlu_dataset.remove_columns('subject')
+            mmlu_data_files = {
+                'eval': 'mmlu/zero_shot_mmlu_val.json',
+                'test': 'mmlu/zero_shot_mmlu_test.json',
+            }
         #  MMLU Five-shot (Eval/Test only)
         elif args.mmlu_dataset in ['mmlu', 'mmlu-fs']:
-            mmlu_dataset = load_dataset(
-                'json',
-                data_files={
-                    'eval':
-                    os.path.join(data_dir, 'mmlu/five_shot_mmlu_val.json'),
-                    'test':
-                    os.path.join(data_dir, 'mmlu/five_shot_mmlu_test.json'),
-                },
-            )
+            mmlu_data_files = {
+                'eval': 'mmlu/five_shot_mmlu_val.json',
+                'test': 'mmlu/five_shot_mmlu_test.json',
+            }
         else:
             raise ValueError(
                 f"Invalid value '{args.mmlu_dataset}' for argument 'mmlu_dataset'."
             )
 
-        # Select the appropriate split of the dataset and limit the number of samples to evaluate.
+        # Only load the split to evaluate on, the dataset is kept as a memory-mapped Arrow table.
+        mmlu_dataset = load_dataset(
+            'json',
+            data_files={
+                args.mmlu_split:
+                os.path.join(data_dir, mmlu_data_files[args.mmlu_split]),
+            },
+        )
+        # The 'subject' column is kept for every MMLU variant, it is needed for the per-subject accuracy.
+
+        # Select the split of the dataset and limit the number of samples to evaluate.
         self.mmlu_dataset = mmlu_dataset[args.mmlu_split]
         if args.max_mmlu_samples is not None:
             self.mmlu_dataset = self.mmlu_dataset.select(
@@ -256,8 +255,11 @@ class MMLUEvalCallback(TrainerCallback):
             tokenizer('C', add_special_tokens=False).input_ids[0],
             tokenizer('D', add_special_tokens=False).input_ids[0],
         ]
-        # Load the accuracy metric for evaluating MMLU performance.
-        self.accuracy = evaluate.load('accuracy')
+        self.abcd_idx_tensor = torch.tensor(self.abcd_idx, dtype=torch.long)
+        # Lookup table mapping the token IDs of A, B, C, and D to their answer index (-1 for any other token).
+        self.abcd_lut = torch.full((len(tokenizer), ), -1, dtype=torch.long)
+        self.abcd_lut[self.abcd_idx_tensor] = torch.arange(
+            len(self.abcd_idx))
         self.mmlu_dataset = SupervisedDataset(
             self.mmlu_dataset,
             tokenizer=tokenizer,
@@ -266,6 +268,18 @@ class MMLUEvalCallback(TrainerCallback):
             train_on_source=args.train_on_source,
             predict_with_generate=args.predict_with_generate,
         )
+        # Build the data loader once with the trainer's dataloader settings, keeping its worker processes alive
+        # across evaluations. Like `Trainer.get_eval_dataloader`, it is prepared by the accelerator, so that
+        # under distributed training each process only evaluates its own shard of the split.
+        self.data_loader = trainer.accelerator.prepare(
+            DataLoader(
+                self.mmlu_dataset,
+                batch_size=args.per_device_eval_batch_size,
+                num_workers=args.dataloader_num_workers,
+                persistent_workers=args.dataloader_num_workers > 0,
+                pin_memory=args.dataloader_pin_memory,
+                collate_fn=trainer.data_collator,
+            ))
 
     def on_evaluate(
         self,
@@ -284,54 +298,65 @@ class MMLUEvalCallback(TrainerCallback):
             control (Dict[str, Any]): Dictionary containing the evaluation control variables.
             model (PreTrainedModel): The model being evaluated.
         """
-        # Get the evaluation data loader and set the maximum length of the source sequence.
-
-        data_loader = self.trainer.get_eval_dataloader(self.mmlu_dataset)
+        # Get the evaluation data loader.
+        data_loader = self.data_loader
 
         # Set the trainer model in evaluation mode and initialize empty lists for predictions and references.
+        # Predictions, references and loss are kept on the device and only copied to the host after the loop.
+        # They are gathered from all the processes, so every process computes the accuracy on the whole split.
+        accelerator = self.trainer.accelerator
         self.trainer.model.eval()
         preds, refs = [], []
         loss_mmlu = 0
 
         # Iterate over the batches of the evaluation dataset and make predictions.
         for batch in tqdm(data_loader, total=len(data_loader)):
+            batch = {
+                k: v.to(model.device, non_blocking=True)
+                for k, v in batch.items()
+            }
             (loss, logits, labels) = self.trainer.prediction_step(
                 self.trainer.model,
                 batch,
                 prediction_loss_only=False,
             )
 
-            # Extract the predictions for A, B, C, and D tokens.
-            for i, logit in enumerate(logits):
-                label_non_zero_id = (batch['labels'][i] !=
-                                     IGNORE_INDEX).nonzero()[0][0]
-
-                logit_abcd = logit[label_non_zero_id - 1][self.abcd_idx]
-                preds.append(torch.argmax(logit_abcd).item())
+            # Extract the predictions for A, B, C, and D tokens at the position preceding each first label,
+            # for the whole batch at once.
+            label_positions = (batch['labels'] != IGNORE_INDEX).int().argmax(
+                dim=1) - 1
+            label_positions = label_positions.to(logits.device)
+            batch_indices = torch.arange(logits.size(0), device=logits.device)
+            self.abcd_idx_tensor = self.abcd_idx_tensor.to(logits.device)
+            logits_abcd = logits[batch_indices,
+                                 label_positions][:, self.abcd_idx_tensor]
+            preds.append(
+                accelerator.gather_for_metrics(logits_abcd.argmax(dim=-1)))
 
             # Extract the ground truth labels and compute the accuracy by subject.
             labels = labels[labels != IGNORE_INDEX].view(-1, 2)[:, 0]
-            refs += [self.abcd_idx.index(label) for label in labels.tolist()]
-            loss_mmlu += loss.item()
+            self.abcd_lut = self.abcd_lut.to(labels.device)
+            refs.append(accelerator.gather_for_metrics(self.abcd_lut[labels]))
+            loss_mmlu += loss.detach()
+
+        loss_mmlu = accelerator.reduce(loss_mmlu, reduction='mean')
+        preds = torch.cat(preds).tolist()
+        refs = torch.cat(refs).tolist()
 
         # Extract results by subject.
-        results = {'mmlu_loss': loss_mmlu / len(data_loader)}
-        subject = self.mmlu_dataset['subject']
-        subjects = {s: {'refs': [], 'preds': []} for s in set(subject)}
-        for s, p, r in zip(subject, preds, refs):
-            subjects[s]['preds'].append(p)
-            subjects[s]['refs'].append(r)
-
-        # Compute the accuracy score for each subject and log the results.
-        subject_scores = []
-        for subject in subjects:
-            subject_score = self.accuracy.compute(
-                references=subjects[subject]['refs'],
-                predictions=subjects[subject]['preds'])['accuracy']
-            results[
-                f'mmlu_{args.mmlu_split}_accuracy_{subject}'] = subject_score
-            subject_scores.append(subject_score)
+        results = {'mmlu_loss': float(loss_mmlu) / len(data_loader)}
+        subject = np.asarray(self.mmlu_dataset.dataset['subject'])
+        subjects, subject_ids = np.unique(subject, return_inverse=True)
+
+        # Compute the accuracy score for each subject in one pass and log the results.
+        correct = np.asarray(preds) == np.asarray(refs)
+        subject_scores = np.bincount(subject_ids,
+                                     weights=correct) / np.bincount(subject_ids)
+        for s, subject_score in zip(subjects, subject_scores):
+            results[f'mmlu_{args.mmlu_split}_accuracy_{s}'] = float(
+                subject_score)
 
         # Compute the overall MMLU accuracy and log the results.
-        results[f'mmlu_{args.mmlu_split}_accuracy'] = np.mean(subject_scores)
+        results[f'mmlu_{args.mmlu_split}_accuracy'] = float(
+            np.mean(subject_scores))
         self.trainer.log(results)
@@ -19,6 +19,13 @@ class ModelArguments:
             'help':
             'Enables using Huggingface auth token from Git Credentials.'
         })
+    mean_resizing: bool = field(
+        default=True,
+        metadata={
+            'help':
+            'Initialize new token embeddings with the mean of the existing ones, '
+            'otherwise use a normal initialization.'
+        })
 
 
 @dataclass
@@ -1,20 +1,37 @@
 import argparse
+import contextlib
+import copy
+import inspect
 import os
-from os.path import exists, isdir, join
-from typing import Any, Dict, List, Tuple
+import re
+import shutil
+import tempfile
+from collections import defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
+from os.path import isdir, join
+from typing import Any, Dict, List, Optional, Tuple
 
 import bitsandbytes as bnb
+import safetensors.torch
 import torch
 import transformers
+from peft import get_peft_model_state_dict
+from peft.utils import SAFETENSORS_WEIGHTS_NAME as ADAPTER_SAFETENSORS_WEIGHTS_NAME
+from peft.utils import WEIGHTS_NAME as ADAPTER_WEIGHTS_NAME
 from transformers import PreTrainedModel, PreTrainedTokenizer
+from transformers.integrations import is_deepspeed_zero3_enabled
 from transformers.trainer_utils import PREFIX_CHECKPOINT_DIR
+from transformers.utils import WEIGHTS_NAME
 
 from chatllms.data.data_utils import (DEFAULT_BOS_TOKEN, DEFAULT_EOS_TOKEN,
                                       DEFAULT_PAD_TOKEN, DEFAULT_UNK_TOKEN)
 
+_CHECKPOINT_RE = re.compile(r'^checkpoint-(\d+)$')
+
 
 def add_special_tokens_if_missing(tokenizer: PreTrainedTokenizer,
-                                  model: PreTrainedModel):
+                                  model: PreTrainedModel,
+                                  mean_resizing: bool = True):
     """
     If 'llama' or 'baichuan' is in the model name or path, check if the special tokens are set correctly.
     Add any missing special tokens to prevent them from being parsed into different tokens.
@@ -24,6 +41,7 @@ def add_special_tokens_if_missing(tokenizer: PreTrainedTokenizer,
     Args:
         tokenizer: The pre-trained tokenizer.
         model: The pre-trained model.
+        mean_resizing: Whether to initialize the new embeddings with the average of the existing ones.
 
     Returns:
         None.
@@ -41,22 +59,40 @@ def add_special_tokens_if_missing(tokenizer: PreTrainedTokenizer,
     if tokenizer.unk_token is None:
         special_tokens_dict['unk_token'] = DEFAULT_UNK_TOKEN
 
-    # If there are any missing special tokens, call `smart_tokenizer_and_embedding_resize()` to add them to the
-    # tokenizer and resize the embedding accordingly.
+    # Missing special tokens whose default value is already in the vocabulary only need to be set on the
+    # tokenizer, the embedding does not have to be resized for them.
+    # Membership is checked on the vocabulary itself, as unknown tokens may map to id 0 when `unk_token` is unset.
+    vocab = tokenizer.get_vocab()
+    existing_tokens_dict: Dict[str, Any] = {}
+    for key, token in list(special_tokens_dict.items()):
+        if token in vocab:
+            existing_tokens_dict[key] = special_tokens_dict.pop(key)
+    if len(existing_tokens_dict) > 0:
+        tokenizer.add_special_tokens(existing_tokens_dict)
+
+    # If there are any special tokens that extend the vocabulary, call `smart_tokenizer_and_embedding_resize()`
+    # to add them to the tokenizer and resize the embedding accordingly.
     if len(special_tokens_dict) > 0:
-        smart_tokenizer_and_embedding_resize(special_tokens_dict, tokenizer,
-                                             model)
+        smart_tokenizer_and_embedding_resize(special_tokens_dict,
+                                             tokenizer,
+                                             model,
+                                             mean_resizing=mean_resizing)
 
 
 def smart_tokenizer_and_embedding_resize(special_tokens_dict: Dict[str, str],
                                          tokenizer: PreTrainedTokenizer,
-                                         model: PreTrainedModel) -> None:
+                                         model: PreTrainedModel,
+                                         pad_to_multiple_of: int = 64,
+                                         mean_resizing: bool = True) -> None:
     """Resize tokenizer and embedding to accommodate new special tokens.
 
     Args:
         special_tokens_dict (Dict[str, str]): A dictionary of special tokens to be added to the tokenizer.
         tokenizer (PreTrainedTokenizer): The tokenizer object to be resized.
         model (PreTrainedModel): The model object whose token embeddings are to be resized.
+        pad_to_multiple_of (int): Pad the embedding matrix to a multiple of this value. Default is 64.
+        mean_resizing (bool): Initialize the new embeddings with the average of the existing ones. \
+            If False, draw them from a normal distribution instead, skipping the reduction. Default is True.
 
     Returns:
         None
@@ -66,25 +102,59 @@ def smart_tokenizer_and_embedding_resize(special_tokens_dict: Dict[str, str],
     have been added, the function computes the average embedding values of the existing embeddings
     and sets those values for the new special token embeddings. This is done separately for the input
     embeddings and output embeddings of the model.
+
+    The embedding matrix is padded to a multiple of `pad_to_multiple_of` rows so that the vocab
+    dimension of the embedding and LM head matmuls stays Tensor Core friendly. The padding rows
+    are initialized with the same average embedding as the new special tokens.
+    Under DeepSpeed ZeRO-3 the embeddings are gathered once before being modified.
     """
-    num_new_tokens = tokenizer.add_special_tokens(special_tokens_dict)
+    old_vocab = model.get_input_embeddings().num_embeddings
+    tokenizer.add_special_tokens(special_tokens_dict)
+
+    # Resize token embeddings to match tokenizer, padded to a Tensor Core friendly size.
+    # Recent versions of transformers initialize the new rows themselves, skip it as they are initialized below.
+    resize_kwargs = {'pad_to_multiple_of': pad_to_multiple_of}
+    if 'mean_resizing' in inspect.signature(
+            model.resize_token_embeddings).parameters:
+        resize_kwargs['mean_resizing'] = False
+    model.resize_token_embeddings(len(tokenizer), **resize_kwargs)
+    new_vocab = model.get_input_embeddings().num_embeddings
+
+    # May exceed the number of added tokens because of the padding rows
+    num_new = new_vocab - old_vocab
+    if num_new > 0:
+        input_embeddings = model.get_input_embeddings().weight
+        output_embeddings = model.get_output_embeddings().weight
+        std = getattr(model.config, 'initializer_range', 0.02)
+
+        # Under ZeRO-3 the embeddings are partitioned, gather them once instead of per row
+        if is_deepspeed_zero3_enabled():
+            import deepspeed
+            gather_context = deepspeed.zero.GatheredParameters(
+                [input_embeddings, output_embeddings], modifier_rank=0)
+        else:
+            gather_context = contextlib.nullcontext()
 
-    # Resize token embeddings to match tokenizer
-    model.resize_token_embeddings(len(tokenizer))
+        with gather_context:
+            # Set average (or normal) embeddings for new special token and padding embeddings
+            _init_new_embeddings(input_embeddings.data, old_vocab,
+                                 mean_resizing, std)
+            _init_new_embeddings(output_embeddings.data, old_vocab,
+                                 mean_resizing, std)
 
-    if num_new_tokens > 0:
-        input_embeddings = model.get_input_embeddings().weight.data
-        output_embeddings = model.get_output_embeddings().weight.data
 
-        # Compute average embeddings of existing tokens
-        input_embeddings_avg = input_embeddings[:-num_new_tokens].mean(
-            dim=0, keepdim=True)
-        output_embeddings_avg = output_embeddings[:-num_new_tokens].mean(
+def _init_new_embeddings(embeddings: torch.Tensor, old_vocab: int,
+                         mean_resizing: bool, std: float) -> None:
+    """
+    Initializes the rows of `embeddings` past `old_vocab`, either with the average of the existing
+    rows (computed in float32) or from a normal distribution with standard deviation `std`.
+    """
+    if mean_resizing:
+        embeddings_avg = embeddings[:old_vocab].to(torch.float32).mean(
             dim=0, keepdim=True)
-
-        # Set average embeddings for new special token embeddings
-        input_embeddings[-num_new_tokens:] = input_embeddings_avg
-        output_embeddings[-num_new_tokens:] = output_embeddings_avg
+        embeddings[old_vocab:] = embeddings_avg.to(embeddings.dtype)
+    else:
+        torch.nn.init.normal_(embeddings[old_vocab:], mean=0.0, std=std)
 
 
 def find_all_linear_names(args: argparse.Namespace,
@@ -97,18 +167,17 @@ def find_all_linear_names(args: argparse.Namespace,
         model (torch.nn.Module): The PyTorch model to extract linear layer names from.
 
     Returns:
-        List[str]: A list of names of all linear layers present in the given model.
+        List[str]: A sorted list of names of all linear layers present in the given model.
 
     Raises:
         TypeError: If `args` is not an instance of `argparse.Namespace`, or if `model` is not an instance \
             of `torch.nn.Module`.
-        ValueError: If `args.bits` is not 4 or 8.
 
     Example Usage:
         >>> import argparse
         >>> parser = argparse.ArgumentParser()
         >>> parser.add_argument('--bits', type=int)
-        >>> args = parser.parse_args(['--bits', '4'])
+        >>> args = parser.parse_args(['--bits', '16'])
         >>> model = torch.nn.Sequential(torch.nn.Linear(10, 5), torch.nn.Linear(5, 1))
         >>> find_all_linear_names(args, model)
         ['0', '1']
@@ -119,22 +188,51 @@ def find_all_linear_names(args: argparse.Namespace,
     elif args.bits == 8:
         cls = bnb.nn.Linear8bitLt
     else:
-        torch.nn.Linear
+        cls = torch.nn.Linear
 
     lora_module_names = set()
     for name, module in model.named_modules():
-        # Check if the current module is an instance of the linear layer class
-        if isinstance(module, cls):
-            # If yes, split the name of the module into its component parts and add the first or last part to the set
-            names = name.split('.')
-            lora_module_names.add(names[0] if len(names) == 1 else names[-1])
+        # Check if the current module is exactly the linear layer class (cheaper than `isinstance`)
+        if type(module) is cls:
+            # If yes, add the last component of the module name to the set
+            lora_module_names.add(name.rsplit('.', 1)[-1])
 
     # Remove 'lm_head' from the set if present (needed for 16-bit)
     if 'lm_head' in lora_module_names:
         lora_module_names.remove('lm_head')
 
-    # Convert the set into a list and return it
-    return list(lora_module_names)
+    # Convert the set into a sorted list so that all processes agree on the order
+    return sorted(lora_module_names)
+
+
+def summarize_model(model: torch.nn.Module) -> Dict[str, Any]:
+    """
+    Counts the parameters of the given model in a single pass over its parameters.
+
+    Args:
+        model (torch.nn.Module): The PyTorch model to summarize.
+
+    Returns:
+        Dict[str, Any]: A dictionary with the total number of parameters (`all_param`), the number of \
+            trainable parameters (`trainable_params`) and the number of parameters per dtype (`dtypes`).
+    """
+    trainable_params = 0
+    all_param = 0
+    dtypes = defaultdict(int)
+
+    for param in model.parameters():
+        num_params = param.numel()
+        all_param += num_params
+        dtypes[param.dtype] += num_params
+        # Add its number of elements to the trainable parameters count
+        if param.requires_grad:
+            trainable_params += num_params
+
+    return {
+        'all_param': all_param,
+        'trainable_params': trainable_params,
+        'dtypes': dict(dtypes),
+    }
 
 
 def print_trainable_parameters(args: argparse.Namespace,
@@ -143,7 +241,7 @@ def print_trainable_parameters(args: argparse.Namespace,
     Prints the number of trainable parameters in the given model.
 
     Args:
-        args (argparse.Namespace): A namespace containing arguments of the script. Must contain the 'bits' argument.
+        args (argparse.Namespace): A namespace containing arguments of the script.
         model (torch.nn.Module): The PyTorch model to count trainable parameters in.
 
     Raises:
@@ -157,23 +255,11 @@ def print_trainable_parameters(args: argparse.Namespace,
         >>> args = parser.parse_args(['--bits', '4'])
         >>> model = torch.nn.Sequential(torch.nn.Linear(10, 5), torch.nn.Linear(5, 1))
         >>> print_trainable_parameters(args, model)
-        trainable params: 13.0 || all params: 61 || trainable: 21.311475409836067%
+        trainable params: 61 || all params: 61 || trainable: 100.0%
     """
-    trainable_params = 0
-    all_param = 0
-
-    # Iterate through all the named parameters of the model
-    for _, param in model.named_parameters():
-        all_param += param.numel()
-        # Add the number of elements in the parameter tensor to the total count
-        if param.requires_grad:  # If the parameter requires gradient computation during backpropagation
-            trainable_params += param.numel()
-            # Add its number of elements to the trainable parameters count
-
-    # If args.bits is 4, divide the trainable params count by 2 \
-    # (since each 4-bit element requires only 2 bits for storage)
-    if args.bits == 4:
-        trainable_params /= 2
+    summary = summarize_model(model)
+    trainable_params = summary['trainable_params']
+    all_param = summary['all_param']
 
     # Compute and print the percentage of trainable vs all parameters
     trainable_percent = 100 * trainable_params / all_param
@@ -189,18 +275,10 @@ def verify_dtypes(model: torch.nn.Module) -> None:
     :param model: 待检查的模型.
     :return: 无返回值.
     """
-    # 创建一个空字典dtypes，用于记录模型参数的数据类型及其数量.
-    dtypes = {}
-
-    # 遍历模型参数，并统计每种数据类型出现的次数.
-    for _, p in model.named_parameters():
-        dtype = p.dtype
-        if dtype not in dtypes:
-            dtypes[dtype] = 0
-        dtypes[dtype] += p.numel()
-
-    # 计算总共的参数数量total.
-    total = sum(dtypes.values())
+    # 统计每种数据类型的参数数量以及总共的参数数量total.
+    summary = summarize_model(model)
+    dtypes = summary['dtypes']
+    total = summary['all_param']
 
     # 输出各个数据类型的数量以及所占比例.
     for k, v in dtypes.items():
@@ -223,18 +301,21 @@ def get_last_checkpoint(checkpoint_dir: str) -> Tuple[str, bool]:
     # Check if provided directory exists
     if isdir(checkpoint_dir):
 
-        # Check if 'completed' file exists in the directory - indicates training has completed
-        is_completed = exists(join(checkpoint_dir, 'completed'))
+        # Scan the directory once: look for the 'completed' file, which indicates training has completed,
+        # and find the latest checkpoint among all subdirectories named 'checkpoint-*'
+        is_completed = False
+        max_step = 0
+        with os.scandir(checkpoint_dir) as it:
+            for entry in it:
+                if entry.name == 'completed':
+                    is_completed = True
+                    break
+                match = _CHECKPOINT_RE.match(entry.name)
+                if match and entry.is_dir():
+                    max_step = max(max_step, int(match.group(1)))
+
         if is_completed:
             return None, True  # Already finished
-
-        # Find the latest checkpoint by checking all subdirectories named 'checkpoint-*'
-        max_step = 0
-        for filename in os.listdir(checkpoint_dir):
-            if isdir(join(checkpoint_dir,
-                          filename)) and filename.startswith('checkpoint'):
-                max_step = max(max_step,
-                               int(filename.replace('checkpoint-', '')))
         if max_step == 0:
             return None, is_completed  # Training started, but no checkpoint found
 
@@ -250,7 +331,12 @@ def get_last_checkpoint(checkpoint_dir: str) -> Tuple[str, bool]:
 class SavePeftModelCallback(transformers.TrainerCallback):
     """
     A TrainerCallback that saves the PEFT model checkpoint during training.
+    The checkpoints are written by a background thread so that the next training steps are not blocked.
     """
+    def __init__(self) -> None:
+        self._pool: Optional[ThreadPoolExecutor] = None
+        self._pending: List[Future] = []
+
     def save_model(self, args: Any, state: transformers.TrainingArguments,
                    kwargs: Dict[str, Any]) -> None:
         """
@@ -278,14 +364,57 @@ class SavePeftModelCallback(transformers.TrainerCallback):
 
         # Create path for the PEFT model
         peft_model_path = os.path.join(checkpoint_folder, 'adapter_model')
-        kwargs['model'].save_pretrained(peft_model_path)
 
-        # Create path for the PyTorch model binary file and remove it if it already exists
-        pytorch_model_path = os.path.join(checkpoint_folder,
-                                          'pytorch_model.bin')
-        if os.path.exists(pytorch_model_path):
+        # Snapshot the (small) adapter weights on the host, as training keeps updating them in place, and write
+        # the adapter config on the main thread. Only the tensor write is left to the background thread.
+        model = kwargs['model']
+        os.makedirs(checkpoint_folder, exist_ok=True)
+        tmp_path = tempfile.mkdtemp(prefix='adapter_model.tmp-',
+                                    dir=checkpoint_folder)
+        state_dict = {
+            name: tensor.detach().cpu().clone().contiguous()
+            for name, tensor in get_peft_model_state_dict(model).items()
+        }
+        peft_config = copy.deepcopy(model.peft_config[model.active_adapter])
+        peft_config.inference_mode = True
+        if peft_config.base_model_name_or_path is None:
+            peft_config.base_model_name_or_path = model.config.name_or_path
+        peft_config.save_pretrained(tmp_path)
+        self._pending.append(self._get_pool().submit(
+            self._write_adapter, state_dict, tmp_path, peft_model_path,
+            getattr(args, 'save_safetensors', False)))
+
+        # `Trainer` only writes the adapter weights for PEFT models, but remove the full model weights if present
+        pytorch_model_path = os.path.join(checkpoint_folder, WEIGHTS_NAME)
+        with contextlib.suppress(FileNotFoundError):
             os.remove(pytorch_model_path)
 
+    def _get_pool(self) -> ThreadPoolExecutor:
+        """
+        Returns the background writer, created lazily so that the callback can be reused across `train()` calls.
+        """
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=1)
+        return self._pool
+
+    @staticmethod
+    def _write_adapter(state_dict: Dict[str, torch.Tensor], tmp_path: str,
+                       peft_model_path: str, safe_serialization: bool) -> None:
+        """
+        Writes the adapter weights next to the config in `tmp_path` and moves the directory into
+        `peft_model_path` once complete, so that an interrupted write never leaves a partial adapter behind.
+        """
+        if safe_serialization:
+            safetensors.torch.save_file(
+                state_dict,
+                os.path.join(tmp_path, ADAPTER_SAFETENSORS_WEIGHTS_NAME),
+                metadata={'format': 'pt'})
+        else:
+            torch.save(state_dict, os.path.join(tmp_path,
+                                                ADAPTER_WEIGHTS_NAME))
+        shutil.rmtree(peft_model_path, ignore_errors=True)
+        os.replace(tmp_path, peft_model_path)
+
     def on_save(
         self, args: Any, state: transformers.TrainingArguments,
         control: transformers.trainer_callback.TrainerControl,
@@ -314,7 +443,8 @@ class SavePeftModelCallback(transformers.TrainerCallback):
                      control: transformers.trainer_callback.TrainerControl,
                      **kwargs: Dict[str, Any]) -> None:
         """
-        Callback method that saves the model checkpoint and creates a 'completed' file in the output directory.
+        Callback method that saves the model checkpoint, waits for all the pending checkpoints to be written \
+            and creates a 'completed' file in the output directory.
 
         Args:
             args (Any): The command line arguments passed to the script.
@@ -327,13 +457,18 @@ class SavePeftModelCallback(transformers.TrainerCallback):
             TypeError: If `state` is not an instance of `transformers.TrainingArguments`.
         """
 
-        # Define a helper function to create a 'completed' file in the output directory
-        def touch(fname, times=None):
-            with open(fname, 'a'):
-                os.utime(fname, times)
-
-        # Create the 'completed' file in the output directory
-        touch(os.path.join(args.output_dir, 'completed'))
-
         # Save the model checkpoint
         self.save_model(args, state, kwargs)
+
+        # Wait for all the pending checkpoints to be written before marking the training as completed
+        for future in self._pending:
+            future.result()
+        self._pending.clear()
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+
+        # Create the 'completed' file in the output directory
+        fd = os.open(os.path.join(args.output_dir, 'completed'),
+                     os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        os.close(fd)
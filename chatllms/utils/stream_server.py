@@ -4,8 +4,9 @@ Borrowed from https://github.com/oobabooga/text-generation-webui/blob/ad37f396fc
 """
 import traceback
 from queue import Queue
-from threading import Thread
+from threading import Event, Thread
 
+import torch
 import transformers
 
 
@@ -19,6 +20,20 @@ class Stream(transformers.StoppingCriteria):
         return False
 
 
+class StopOnEvent(transformers.StoppingCriteria):
+    """
+    Stops generation once `event` is set, e.g. when the client of a streamed reply went away.
+    """
+    def __init__(self, event: Event):
+        self.event = event
+
+    def __call__(self, input_ids, scores, **kwargs) -> torch.BoolTensor:
+        return torch.full((input_ids.shape[0], ),
+                          self.event.is_set(),
+                          dtype=torch.bool,
+                          device=input_ids.device)
+
+
 class Iteratorize:
     """
     Transforms a function that takes a callback
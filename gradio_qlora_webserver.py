@@ -1,14 +1,21 @@
 import argparse
+import contextlib
+import copy
+import functools
+from collections import defaultdict
 from dataclasses import dataclass, field
+from threading import Event, Thread
 from typing import Optional, Union
 
 import gradio as gr
 import torch
 import transformers
-from transformers import AutoTokenizer, GenerationConfig
+from transformers import AutoTokenizer, TextIteratorStreamer
 
 from chatllms.model.get_server_model import get_server_model
-from chatllms.utils.stream_server import Iteratorize, Stream
+from chatllms.utils.stream_server import StopOnEvent
+
+torch.backends.cuda.matmul.allow_tf32 = True
 
 ALPACA_PROMPT_DICT = {
     'prompt_input':
@@ -42,6 +49,10 @@ class Prompter:
         """
         self.PROMPT_DICT = ALPACA_PROMPT_DICT if prompt_template == 'alpaca' else PROMPT_DICT
         self.reponse_split = '### Response:'
+        # Bind the formatting of both templates once instead of looking them up on every request.
+        self._format_prompt_input = self.PROMPT_DICT['prompt_input'].format_map
+        self._format_prompt_no_input = self.PROMPT_DICT[
+            'prompt_no_input'].format_map
 
     def generate_prompt(self,
                         instruction: str,
@@ -58,14 +69,9 @@ class Prompter:
         Returns:
             str: The generated prompt text.
         """
-        prompt_input, prompt_no_input = self.PROMPT_DICT[
-            'prompt_input'], self.PROMPT_DICT['prompt_no_input']
-
-        if input is not None:
-            prompt_text = prompt_input.format(instruction=instruction,
-                                              input=input)
-        else:
-            prompt_text = prompt_no_input.format(instruction=instruction)
+        format_prompt = (self._format_prompt_input if input is not None else
+                         self._format_prompt_no_input)
+        prompt_text = format_prompt({'instruction': instruction, 'input': input})
 
         if response:
             prompt_text = f'{prompt_text}{response}'
@@ -82,7 +88,7 @@ class Prompter:
         Returns:
             str: The extracted response.
         """
-        return output.split(self.reponse_split)[1].strip()
+        return output.split(self.reponse_split, 2)[1].strip()
 
 
 @dataclass
@@ -122,6 +128,33 @@ class ModelServerArguments:
             'help':
             'Enables using Huggingface auth token from Git Credentials.'
         })
+    max_batch_size: int = field(
+        default=8,
+        metadata={
+            'help':
+            'Maximum number of concurrent requests batched into a single generate call. '
+            'Set to 1 to disable batching and enable streaming output.'
+        })
+    attn_implementation: Optional[str] = field(
+        default=None,
+        metadata={
+            'help':
+            'Attention implementation to use: `eager`, `sdpa` or `flash_attention_2`. '
+            'Defaults to `flash_attention_2` if flash-attn is installed and the model is loaded in fp16/bf16, '
+            '`sdpa` otherwise.'
+        })
+    stream_timeout: float = field(
+        default=60.0,
+        metadata={
+            'help':
+            'Seconds to wait for the next streamed token before giving up on a request.'
+        })
+    compile: bool = field(
+        default=False,
+        metadata={
+            'help':
+            'Compile the model forward with `torch.compile` (requires torch>=2.0).'
+        })
 
 
 def main():
@@ -132,6 +165,15 @@ def main():
     args.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
     model = get_server_model(args)
+    if args.compile:
+        # Avoid recompilation thrash across different prompt lengths.
+        torch._dynamo.config.cache_size_limit = 64
+        # `generate` calls the forward of the underlying transformers model, so compile that one.
+        base_model = model.get_base_model()
+        base_model.forward = torch.compile(base_model.forward,
+                                           mode='reduce-overhead',
+                                           fullgraph=False,
+                                           dynamic=True)
     # Tokenizer
     tokenizer = AutoTokenizer.from_pretrained(
         args.model_name_or_path,
@@ -143,8 +185,49 @@ def main():
         use_auth_token=args.use_auth_token,
         trust_remote_code=args.trust_remote_code,
     )
+    batching = args.max_batch_size > 1
+    if batching:
+        # Batched generation of a decoder-only model needs the prompts to be left padded.
+        tokenizer.padding_side = 'left'
+        if tokenizer.pad_token_id is None:
+            tokenizer.pad_token_id = 0  # unk
     prompter = Prompter()
 
+    # Same compute dtype as `get_server_model`, the model runs in float32 unless --fp16 or --bf16 is set.
+    compute_dtype = (torch.float16 if args.fp16 else
+                     (torch.bfloat16 if args.bf16 else torch.float32))
+
+    @contextlib.contextmanager
+    def inference_context():
+        # `inference_mode` skips the version counter and view tracking `no_grad` still does,
+        # autocast keeps the matmuls in the compute dtype of the quantized model.
+        with torch.inference_mode(), torch.autocast(
+                device_type=args.device.type,
+                dtype=compute_dtype,
+                enabled=args.device.type == 'cuda'
+                and compute_dtype != torch.float32):
+            yield
+
+    # Shared by every request and never modified, the per-request parameters are passed to `generate`
+    # as overrides, which `generate` applies to its own copy of the config.
+    # Built from the model's own config so that its `use_cache` and special token ids are kept.
+    generation_config = copy.deepcopy(model.generation_config)
+    generation_config.do_sample = True
+    if generation_config.pad_token_id is None:
+        generation_config.pad_token_id = tokenizer.pad_token_id
+
+    def sampling_params(temperature, top_p):
+        # A temperature of 0 is rejected by `generate` when sampling, so it is treated as greedy decoding.
+        if temperature <= 0:
+            return {'do_sample': False}
+        return {'temperature': temperature, 'top_p': max(top_p, 1e-5)}
+
+    @functools.lru_cache(maxsize=128)
+    def tokenize_prompt(instruction, input=None):
+        # Cache the tokenized prompts, demo servers often receive identical queries.
+        prompt = prompter.generate_prompt(instruction, input)
+        return tokenizer(prompt, return_tensors='pt').to(args.device)
+
     def evaluate(
         instruction,
         input=None,
@@ -156,111 +239,177 @@ def main():
         stream_output=False,
         **kwargs,
     ):
-        prompt = prompter.generate_prompt(instruction, input)
-        inputs = tokenizer(prompt, return_tensors='pt')
-        inputs = inputs.to(args.device)
-        generation_config = GenerationConfig(
-            temperature=temperature,
-            top_p=top_p,
+        inputs = tokenize_prompt(instruction, input)
+        generation_overrides = dict(
+            **sampling_params(temperature, top_p),
             top_k=top_k,
             num_beams=num_beams,
-            do_sample=True,
             # no_repeat_ngram_size=6,
             # repetition_penalty=1.8,
             **kwargs,
         )
 
-        generate_params = {
-            'input_ids': inputs['input_ids'],
-            'generation_config': generation_config,
-            'return_dict_in_generate': True,
-            'output_scores': True,
-            'max_new_tokens': max_new_tokens,
-        }
-
         if stream_output:
-            # Stream the reply 1 token at a time.
-            # This is based on the trick of using 'stopping_criteria' to create an iterator,
-
-            def generate_with_callback(callback=None, **kwargs):
-                kwargs.setdefault('stopping_criteria',
-                                  transformers.StoppingCriteriaList())
-                kwargs['stopping_criteria'].append(
-                    Stream(callback_func=callback))
-                with torch.no_grad():
-                    model.generate(**kwargs)
+            # Stream the reply with `TextIteratorStreamer`, which only decodes the newly generated tokens
+            # instead of the whole sequence at every step. Streaming does not support beam search.
+            streamer = TextIteratorStreamer(tokenizer,
+                                            skip_prompt=True,
+                                            skip_special_tokens=True,
+                                            timeout=args.stream_timeout)
+            generation_overrides['num_beams'] = 1
+            stop_event = Event()
+            errors = []
 
             def generate_with_streaming(**kwargs):
-                return Iteratorize(generate_with_callback,
-                                   kwargs,
-                                   callback=None)
-
-            with generate_with_streaming(**generate_params) as generator:
-                for output in generator:
-                    # new_tokens = len(output) - len(input_ids[0])
-                    decoded_output = tokenizer.decode(output)
-
-                    if output[-1] in [tokenizer.eos_token_id]:
-                        break
-
-                    yield prompter.get_response(decoded_output)
+                try:
+                    with inference_context():
+                        model.generate(**kwargs)
+                except Exception as e:
+                    errors.append(e)
+                finally:
+                    # Always unblock the consumer, also when `generate` raised.
+                    streamer.end()
+
+            stopping_criteria = transformers.StoppingCriteriaList(
+                [StopOnEvent(stop_event)])
+            thread = Thread(target=generate_with_streaming,
+                            kwargs={
+                                'input_ids': inputs['input_ids'],
+                                'generation_config': generation_config,
+                                'max_new_tokens': max_new_tokens,
+                                'streamer': streamer,
+                                'stopping_criteria': stopping_criteria,
+                                **generation_overrides,
+                            })
+            thread.start()
+
+            try:
+                output = ''
+                for new_text in streamer:
+                    output += new_text
+                    yield output.strip()
+            finally:
+                # Also reached on timeout or when the client went away (GeneratorExit), stop generating then.
+                stop_event.set()
+                thread.join()
+            if errors:
+                raise errors[0]
             return  # early return for stream_output
 
         # Without streaming
-        with torch.no_grad():
+        with inference_context():
             generation_output = model.generate(
                 **inputs,
                 generation_config=generation_config,
                 return_dict_in_generate=True,
                 output_scores=True,
                 max_new_tokens=max_new_tokens,
+                **generation_overrides,
             )
         s = generation_output.sequences[0]
         output = tokenizer.decode(s)
         yield prompter.get_response(output)
 
+    def evaluate_batch(instructions, inputs, temperatures, top_ps, top_ks,
+                       num_beams, max_new_tokens):
+        # Requests are grouped by their generation parameters, each group is generated in one call.
+        groups = defaultdict(list)
+        for i, params in enumerate(
+                zip(temperatures, top_ps, top_ks, num_beams, max_new_tokens)):
+            groups[params].append(i)
+
+        outputs = [None] * len(instructions)
+        for (temperature, top_p, top_k, beams,
+             new_tokens), indices in groups.items():
+            prompts = [
+                prompter.generate_prompt(instructions[i], inputs[i])
+                for i in indices
+            ]
+            batch = tokenizer(prompts, return_tensors='pt',
+                              padding=True).to(args.device)
+            with inference_context():
+                sequences = model.generate(
+                    **batch,
+                    generation_config=generation_config,
+                    max_new_tokens=max(int(new_tokens), 1),
+                    **sampling_params(temperature, top_p),
+                    top_k=max(int(top_k), 0),
+                    num_beams=max(int(beams), 1),
+                )
+
+            # Prompts are left padded, so the generated tokens start at the same position for all of them.
+            responses = tokenizer.batch_decode(
+                sequences[:, batch['input_ids'].shape[1]:],
+                skip_special_tokens=True)
+            for i, response in zip(indices, responses):
+                outputs[i] = response.strip()
+        return [outputs]
+
+    if args.compile:
+        # Warm up with a dummy prompt so that the first request does not pay for the compilation.
+        if batching:
+            evaluate_batch(['Hello'], [None], [1.0], [1.0], [50], [1], [16])
+        else:
+            next(evaluate('Hello', num_beams=1, max_new_tokens=16))
+
     description = 'Baichuan7B is a 7B-parameter LLaMA model finetuned to follow instructions.'
-    server = gr.Interface(
-        fn=evaluate,
-        inputs=[
-            gr.components.Textbox(lines=2,
-                                  label='Instruction',
-                                  placeholder='Tell me about alpacas.'),
-            gr.components.Textbox(lines=2, label='Input', placeholder='none'),
-            gr.components.Slider(minimum=0,
-                                 maximum=1,
-                                 value=1.0,
-                                 label='Temperature'),
-            gr.components.Slider(minimum=0,
-                                 maximum=1,
-                                 value=1.0,
-                                 label='Top p'),
-            gr.components.Slider(minimum=0,
-                                 maximum=100,
-                                 step=1,
-                                 value=50,
-                                 label='Top k'),
-            gr.components.Slider(minimum=1,
-                                 maximum=4,
-                                 step=1,
-                                 value=4,
-                                 label='Beams'),
-            gr.components.Slider(minimum=16,
-                                 maximum=1024,
-                                 step=32,
-                                 value=128,
-                                 label='Max new tokens'),
-            gr.components.Checkbox(label='Stream output'),
-        ],
-        outputs=[gr.inputs.Textbox(
-            lines=5,
-            label='Output',
-        )],
-        title='Baichuan7B',
-        description=description,
-    )
+    input_components = [
+        gr.components.Textbox(lines=2,
+                              label='Instruction',
+                              placeholder='Tell me about alpacas.'),
+        gr.components.Textbox(lines=2, label='Input', placeholder='none'),
+        gr.components.Slider(minimum=0,
+                             maximum=1,
+                             value=1.0,
+                             label='Temperature'),
+        gr.components.Slider(minimum=0,
+                             maximum=1,
+                             value=1.0,
+                             label='Top p'),
+        gr.components.Slider(minimum=0,
+                             maximum=100,
+                             step=1,
+                             value=50,
+                             label='Top k'),
+        gr.components.Slider(minimum=1,
+                             maximum=4,
+                             step=1,
+                             value=4,
+                             label='Beams'),
+        gr.components.Slider(minimum=16,
+                             maximum=1024,
+                             step=32,
+                             value=128,
+                             label='Max new tokens'),
+    ]
+    if batching:
+        server = gr.Interface(
+            fn=evaluate_batch,
+            inputs=input_components,
+            outputs=[gr.inputs.Textbox(
+                lines=5,
+                label='Output',
+            )],
+            title='Baichuan7B',
+            description=description,
+            batch=True,
+            max_batch_size=args.max_batch_size,
+        )
+    else:
+        server = gr.Interface(
+            fn=evaluate,
+            inputs=input_components +
+            [gr.components.Checkbox(label='Stream output')],
+            outputs=[gr.inputs.Textbox(
+                lines=5,
+                label='Output',
+            )],
+            title='Baichuan7B',
+            description=description,
+        )
 
-    server.queue().launch(server_name='0.0.0.0', share=True)
+    server.queue(concurrency_count=1,
+                 max_size=32).launch(server_name='0.0.0.0', share=True)
 
 
 if __name__ == '__main__':
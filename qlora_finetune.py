@@ -202,7 +202,9 @@ def main():
     # Note also that `model.config.pad_token_id` is 0 which corresponds to `<unk>` token.
     logger.info('Adding special tokens.')
     if 'llama' in args.model_name_or_path or 'baichuan' in args.model_name_or_path:
-        add_special_tokens_if_missing(tokenizer, model)
+        add_special_tokens_if_missing(tokenizer,
+                                      model,
+                                      mean_resizing=args.mean_resizing)
 
     dataset_dict = make_data_module(args)
     train_dataset = SupervisedDataset(